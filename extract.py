@@ -4,15 +4,34 @@ import os
 import re
 import logging
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import queue
+import threading
 # from ast import literal_eval
-import numexpr
+import numpy as np
 import cv2
 import pytesseract
-from PIL import Image
+
+# Keep Tesseract's OpenMP pool from fighting our own worker processes
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 # Set the path to the Tesseract executable (update it based on your installation)
 pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
 
+# One Tesseract API instance per OCR worker process, created lazily so the
+# language model is loaded once per worker instead of once per frame
+_tess_api = None
+
+# Strips everything but latin, hebrew and basic punctuation from OCR output
+_CLEAN_RE = re.compile(r'[^A-Za-z0-9א-ת\s\.,!?-]')
+
 config = {
     "language": "heb",
     "clip_region": {
@@ -22,7 +41,11 @@ config = {
         "y1": "height-90"
 
     },
-    "text_color_range": (240, 255)  # This is in grayscale color range.
+    "text_color_range": (240, 255),  # This is in grayscale color range.
+    "sample_fps": 4,  # How many frames to OCR per second of video
+    # Tesseract's LSTM wants text lines around 32-40 px tall, taller
+    # ROIs just cost more compute; 0 disables the downscale
+    "ocr_line_height": 40
 }
 
 
@@ -33,13 +56,38 @@ def get_srt_entry(index: int, start_time: str, end_time: str, text: str) -> str:
     return srt_line
 
 
+# Matches clip region expressions like "width", "height-140" or "height + 90"
+_DIMENSION_EXPR_RE = re.compile(r'^\s*(width|height)\s*(?:([+-])\s*(\d+))?\s*$')
+
+
+def eval_dimension_expr(expr: str, width: int, height: int) -> int:
+    """ Evaluate a clip region expression such as "height-140"
+
+    Args:
+        expr(str): the expression, a dimension plus or minus an offset
+        width(int): the frame width
+        height(int): the frame height
+    Returns:
+        int: the evaluated pixel coordinate
+    """
+    match = _DIMENSION_EXPR_RE.match(expr)
+    if match:
+        value = width if match.group(1) == 'width' else height
+        if match.group(2):
+            offset = int(match.group(3))
+            value = value + offset if match.group(2) == '+' else value - offset
+        return value
+    # Anything fancier goes through eval with a restricted namespace
+    return int(eval(expr, {"__builtins__": {}}, {"width": width, "height": height}))
+
+
 def get_crop_region(width, height):
     """ Retrive the cropping region containing the subtitles """
     logging.debug("Cropping width %s and height %s", width, height)
     ret = {}
     for k, v in config['clip_region'].items():
         if isinstance(v, str):
-            ret[k] = numexpr.evaluate(v).item()
+            ret[k] = eval_dimension_expr(v, width, height)
         elif isinstance(v, int):
             ret[k] = v
     logging.debug("Returning from get_crop_region with %s", ret)
@@ -54,17 +102,38 @@ def crop(frame, region):
 # Function to preprocess and extract text from an image
 
 
+def _get_tess_api():
+    """ Retrieve this process' preloaded Tesseract API, None without tesserocr """
+    global _tess_api
+    if tesserocr is None:
+        return None
+    if _tess_api is None:
+        _tess_api = tesserocr.PyTessBaseAPI(
+            lang=config['language'], psm=tesserocr.PSM.SPARSE_TEXT)
+    return _tess_api
+
+
 def extract_text(image):
     """ Extract text from an image """
     # Increase contrast
     _, img = cv2.threshold(image, 128, 255, cv2.THRESH_BINARY)
 
     # OCR using Tesseract
-    text = pytesseract.image_to_string(Image.fromarray(
-        img), lang=config['language'], config='--psm 11')
+    api = _get_tess_api()
+    if api is not None:
+        # Hand the raw bytes to the already loaded engine,
+        # no temp file and no subprocess fork
+        height, width = img.shape
+        api.SetImageBytes(img.tobytes(), width, height, 1, width)
+        text = api.GetUTF8Text()
+    else:
+        # pytesseract forks a tesseract process and reloads the
+        # language model on every call; it takes the ndarray as is
+        text = pytesseract.image_to_string(
+            img, lang=config['language'], config='--psm 11')
 
     # Post-process text (customize as needed)
-    text = re.sub(r'[^A-Za-z0-9א-ת\s\.,!?-]', '', text)
+    text = _CLEAN_RE.sub('', text)
 
     return text.strip()
 
@@ -81,6 +150,154 @@ def get_output_filename(video_file: str) -> str:
     return ret
 
 
+# Marks a queued frame whose ROI matches the previous frame,
+# so its OCR result can be reused instead of recomputed
+_SAME_AS_PREV = object()
+
+# Fraction of ROI pixels that may differ between frames while
+# still being considered the same subtitle image
+ROI_DIFF_THRESHOLD = 0.005
+
+# How many OCR results to remember, recurring text such as speaker
+# labels repeats throughout a video
+OCR_CACHE_SIZE = 4096
+
+# Fraction of text pixels below which the ROI is considered empty,
+# and above which it is considered a fade or flash rather than text
+FG_MIN_FRACTION = 0.002
+FG_MAX_FRACTION = 0.5
+
+
+def roi_hash(roi_thresh) -> int:
+    """ A 64 bit perceptual hash of a thresholded ROI """
+    small = cv2.resize(roi_thresh, (8, 8), interpolation=cv2.INTER_AREA)
+    bits = (small > small.mean()).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def open_video(video_path: str):
+    """ Open a video, asking for hardware accelerated decode when possible
+
+    VIDEO_ACCELERATION_ANY lets FFmpeg pick whatever decoder the machine
+    offers (NVDEC, VAAPI, ...) and silently falls back to software, so
+    decode moves off the CPU wherever the build supports it.
+
+    Args:
+        video_path(str): the video to open
+    Returns:
+        cv2.VideoCapture: an opened capture
+    """
+    if hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+        cap = cv2.VideoCapture(
+            video_path, cv2.CAP_FFMPEG,
+            [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+        if cap.isOpened():
+            logging.debug("hardware acceleration: %s",
+                          cap.get(cv2.CAP_PROP_HW_ACCELERATION))
+            return cap
+        cap.release()
+    # Older OpenCV or an unsupported container, plain CPU decode
+    return cv2.VideoCapture(video_path)
+
+
+def _ocr_worker_init():
+    """ Keep Tesseract single threaded inside each OCR worker process """
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def display_frames(display_queue, stop_event):
+    """ Show thresholded ROIs in a window until stop_event is set
+
+    Runs on its own thread so the imshow/waitKey event pump never
+    stalls decoding or OCR. Pressing 'q' sets stop_event to end the run.
+
+    Args:
+        display_queue(queue.Queue): receives ROIs to display
+        stop_event(threading.Event): set to stop displaying
+    """
+    while not stop_event.is_set():
+        try:
+            roi = display_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        cv2.imshow('Frame', roi)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            stop_event.set()
+
+
+def decode_frames(cap, frame_count, crop_region, frame_queue, stop_event, step=1):
+    """ Decode, crop and threshold frames, feeding the OCR frame queue
+
+    Args:
+        cap: an opened cv2.VideoCapture
+        frame_count(int): number of frames to decode
+        crop_region(dict): region containing the subtitles
+        frame_queue(queue.Queue): receives (frame_index, thresholded ROI,
+            precomputed text), where precomputed text is None when the
+            frame still needs OCR; on failure the exception is posted,
+            and a None sentinel always follows the last item
+        stop_event(threading.Event): set to abort decoding early
+        step(int): sample every step'th frame
+    """
+    lo, hi = config['text_color_range']
+    # Arrays built once, cv2 would otherwise convert tuples every call
+    lower = np.array((lo, lo, lo), dtype=np.uint8)
+    upper = np.array((hi, hi, hi), dtype=np.uint8)
+    line_height = config['ocr_line_height']
+    prev_hash = None
+    prev_roi_thresh = None
+    try:
+        for i in range(0, frame_count, step):
+            if stop_event.is_set():
+                break
+            ret, frame = cap.read()
+            if not ret:
+                break
+            roi = crop(frame, crop_region)
+            # A single SIMD pass over the ROI instead of a grayscale
+            # conversion followed by a threshold; pixels in the subtitle
+            # colour range come back 255, inverted in place to keep the
+            # previous black-text-on-white polarity without a second buffer
+            roi_thresh = cv2.inRange(roi, lower, upper)
+            cv2.bitwise_not(roi_thresh, roi_thresh)
+            # Downscale tall ROIs, Tesseract's cost grows with pixel count
+            # and the mild downsample tends to denoise as a bonus
+            if line_height and roi_thresh.shape[0] > line_height:
+                new_width = roi_thresh.shape[1] * line_height // roi_thresh.shape[0]
+                roi_thresh = cv2.resize(roi_thresh, (new_width, line_height),
+                                        interpolation=cv2.INTER_AREA)
+            # Subtitles persist for many frames, so OCR only when the ROI
+            # actually changed: a cheap hash compare first, then a pixel
+            # diff to confirm the match
+            precomputed = None
+            current_hash = roi_hash(roi_thresh)
+            if prev_roi_thresh is not None and current_hash == prev_hash:
+                diff = cv2.countNonZero(cv2.absdiff(roi_thresh, prev_roi_thresh))
+                if diff < ROI_DIFF_THRESHOLD * roi_thresh.size:
+                    precomputed = _SAME_AS_PREV
+            if precomputed is None:
+                # Most frames carry no subtitle at all; skip OCR when the
+                # ROI has too few text pixels, or too many (white fades)
+                n_fg = roi_thresh.size - cv2.countNonZero(roi_thresh)
+                if not FG_MIN_FRACTION * roi_thresh.size <= n_fg \
+                        <= FG_MAX_FRACTION * roi_thresh.size:
+                    precomputed = ''
+            prev_hash = current_hash
+            prev_roi_thresh = roi_thresh
+            frame_queue.put((i, roi_thresh, precomputed))
+            # Skip the frames between samples, grab() decodes without
+            # the expensive conversion to a BGR array
+            for _ in range(step - 1):
+                if not cap.grab():
+                    break
+    except Exception as exc:  # pylint: disable=broad-except
+        # A decoder that dies silently leaves the consumer blocked on
+        # the queue forever; hand it the failure so the run aborts loudly
+        frame_queue.put(exc)
+    finally:
+        frame_queue.put(None)
+
+
 # Function to format milliseconds into "hh:mm:ss,SSS" format
 def format_time(milliseconds: int) -> str:
     """ Converts miliseconds to HH: MM: SS, Miliseconds """
@@ -92,15 +309,24 @@ def format_time(milliseconds: int) -> str:
 # Function to process video and generate SRT file
 
 
-def process_video(video_path: str, output_srt: str, display: bool = True):
+def process_video(video_path: str, output_srt: str, display: bool = True, workers: int = None,
+                  sample_fps: float = None):
     """ Process a video and produce an srt file
 
+    Decoding and OCR are pipelined: a decoder thread crops and thresholds
+    frames onto a bounded queue, a pool of worker processes runs Tesseract
+    on them, and the main thread consumes the results in frame order.
+
     Args:
         video_path(str): A video to process
         output_srt(str): an srt file to create
         display(bool): if False don't show the image
+        workers(int): number of OCR worker processes,
+            defaults to a quarter of the CPU count
+        sample_fps(float): how many frames to sample per second of video,
+            subtitles change far slower than the frame rate
     """
-    cap = cv2.VideoCapture(video_path)
+    cap = open_video(video_path)
 
     # Retrieve the frame count and duration
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -117,57 +343,146 @@ def process_video(video_path: str, output_srt: str, display: bool = True):
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     crop_region = get_crop_region(frame_width, frame_height)
-    text_color_range = config['text_color_range']
     logging.debug('cropping: %s', crop_region)
     logging.debug('range: %s', config["text_color_range"])
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 4) // 4)
+    if sample_fps is None:
+        sample_fps = config["sample_fps"]
+    step = max(1, int(fps / sample_fps))
+    logging.debug("using %s OCR workers, sampling every %s frames", workers, step)
+    frame_queue = queue.Queue(maxsize=2 * workers)
+    stop_event = threading.Event()
+    # Millisecond timestamp for every frame index, computed once instead
+    # of doing float maths per frame in the consume loop
+    times_ms = (np.arange(frame_count + step, dtype=np.float64)
+                * (1000.0 / fps)).astype(np.int64)
     # Initialize variables for subtitle tracking
     idx = 0
     current_text = ''
+    last_text = ''
     start_time = 0
     end_time = 0
-    with open(output_srt, 'w', encoding='utf-8') as srt_file:
-        for i in range(frame_count):
-            _, frame = cap.read()
-            # Define region of interest for cropping
-            # roi = frame[frame_height-140:frame_height-90, 0:frame_width]
-            roi = crop(frame, crop_region)
-            _, roi_thresh = cv2.threshold(cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY),
-                                          text_color_range[0],
-                                          text_color_range[1],
-                                          cv2.THRESH_BINARY_INV)
-
-            # Extract text from the region
-            text = extract_text(roi_thresh)
-            if text:  # Skip frames with no text
-                if text == current_text:  # Extend duration if same text is detected
-                    end_time = int(((i + 1) / fps) * 1000)
-                else:  # Start a new subtitle entry
-                    if current_text:
-                        # Create the previous subtitle entry
-                        idx += 1
-                        srt_line = get_srt_entry(
-                            idx, format_time(start_time), format_time(end_time), current_text)
-                        logging.debug(srt_line)
-                        # Write the previous subtitle entry
-                        srt_file.write(srt_line)
-
-                    # Update current subtitle variables
-                    current_text = text
-                    start_time = int((i / fps) * 1000)
-                    end_time = int(((i + 1) / fps) * 1000)
-
-            current_time = int((i / fps) * 1000)
-            print(f'{ current_time/60/60 }: {text}')
-            # Display image and OCR output
-            if display:
-                cv2.imshow('Frame', roi_thresh)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
-        # Write the last subtitle entry
-        if current_text:
-            srt_line = get_srt_entry(
-                idx, format_time(start_time), format_time(end_time), current_text)
-            srt_file.write(srt_line)
+    with open(output_srt, 'w', encoding='utf-8') as srt_file, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_ocr_worker_init) as executor:
+        decoder = threading.Thread(
+            target=decode_frames,
+            args=(cap, frame_count, crop_region, frame_queue, stop_event, step))
+        decoder.start()
+
+        display_queue = None
+        display_thread = None
+        if display:
+            # A single-slot queue with a drop-old policy: when the
+            # display falls behind, frames are skipped, never queued
+            display_queue = queue.Queue(maxsize=1)
+            display_thread = threading.Thread(
+                target=display_frames, args=(display_queue, stop_event))
+            display_thread.start()
+
+        in_flight = {}   # future -> (frame index, thresholded ROI, ROI digest)
+        ready = []       # reorder buffer of (frame index, ROI, text)
+        expected = collections.deque()  # frame indices in decode order
+        ocr_cache = collections.OrderedDict()  # ROI digest -> OCR text
+        decoding = True
+        try:
+            while decoding or in_flight:
+                if stop_event.is_set():
+                    decoding = False
+                # Keep the pool fed, bounded so memory stays flat
+                while decoding and len(in_flight) < 2 * workers:
+                    item = frame_queue.get()
+                    if item is None:
+                        decoding = False
+                        break
+                    if isinstance(item, Exception):
+                        # The decoder thread died, fail here instead of
+                        # waiting forever on frames that will never come
+                        raise item
+                    i, roi_thresh, precomputed = item
+                    expected.append(i)
+                    if precomputed is not None:
+                        # Unchanged or empty ROI, no OCR needed
+                        heapq.heappush(ready, (i, roi_thresh, precomputed))
+                        continue
+                    # Recurring text repeats across the whole video,
+                    # reuse an earlier OCR result for an identical ROI
+                    digest = hashlib.blake2b(
+                        roi_thresh.tobytes(), digest_size=8).digest()
+                    if digest in ocr_cache:
+                        ocr_cache.move_to_end(digest)
+                        heapq.heappush(ready, (i, roi_thresh, ocr_cache[digest]))
+                        continue
+                    future = executor.submit(extract_text, roi_thresh)
+                    in_flight[future] = (i, roi_thresh, digest)
+
+                if in_flight:
+                    done, _ = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        i, roi_thresh, digest = in_flight.pop(future)
+                        text = future.result()
+                        ocr_cache[digest] = text
+                        if len(ocr_cache) > OCR_CACHE_SIZE:
+                            ocr_cache.popitem(last=False)
+                        heapq.heappush(ready, (i, roi_thresh, text))
+
+                # Consume results in frame order so the subtitle merge logic
+                # sees the same sequence a serial pass would
+                while ready and expected and ready[0][0] == expected[0]:
+                    i, roi_thresh, text = heapq.heappop(ready)
+                    expected.popleft()
+                    if text is _SAME_AS_PREV:
+                        text = last_text
+                    last_text = text
+                    if text:  # Skip frames with no text
+                        if text == current_text:  # Extend duration if same text is detected
+                            end_time = int(times_ms[min(i + step, frame_count)])
+                        else:  # Start a new subtitle entry
+                            if current_text:
+                                # Create the previous subtitle entry
+                                idx += 1
+                                srt_line = get_srt_entry(
+                                    idx, format_time(start_time), format_time(end_time), current_text)
+                                logging.debug(srt_line)
+                                # Write the previous subtitle entry
+                                srt_file.write(srt_line)
+
+                            # Update current subtitle variables
+                            current_text = text
+                            start_time = int(times_ms[i])
+                            end_time = int(times_ms[min(i + step, frame_count)])
+
+                    # stdout writes are surprisingly costly in a tight loop,
+                    # only log progress when debugging
+                    logging.debug("%s: %s", format_time(int(times_ms[i])), text)
+                    # Offer the frame to the display thread, dropping it
+                    # if the previous one is still on screen
+                    if display_queue is not None:
+                        try:
+                            display_queue.put_nowait(roi_thresh)
+                        except queue.Full:
+                            pass
+
+            # Write the last subtitle entry
+            if current_text:
+                srt_line = get_srt_entry(
+                    idx, format_time(start_time), format_time(end_time), current_text)
+                srt_file.write(srt_line)
+        finally:
+            # Always reached, a failure above must still unblock and
+            # join the helper threads instead of hanging the process
+            stop_event.set()
+            # Unblock the decoder if it is still waiting on a full queue
+            while decoder.is_alive():
+                try:
+                    frame_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            decoder.join()
+            if display_thread is not None:
+                display_thread.join()
 
     cap.release()
     cv2.destroyAllWindows()
@@ -183,7 +498,13 @@ def main():
         '--output', "-o", help='A video file to extract subtitles from')
     parser.add_argument("--dont-display", "-d",
                         action='store_true', help="Dont display the OCR image")
+    parser.add_argument("--sample-fps", type=float, default=config["sample_fps"],
+                        help="How many frames to OCR per second of video")
+    parser.add_argument("--ocr-line-height", type=int, default=config["ocr_line_height"],
+                        help="Downscale the subtitle region to this height "
+                             "before OCR, 0 to disable")
     args = parser.parse_args()
+    config["ocr_line_height"] = args.ocr_line_height
     video_path = args.video
     dont_display = args.dont_display
     logging.info("Processing video %s", video_path)
@@ -192,7 +513,8 @@ def main():
     else:
         output_srt = get_output_filename(video_path)
     logging.info("Saving to %s", output_srt)
-    process_video(video_path, output_srt, display=not dont_display)
+    process_video(video_path, output_srt, display=not dont_display,
+                  sample_fps=args.sample_fps)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 #!/bin/python
 """ Attempts to fix a polluted srt subtitle file """
-import io
 import os
 import sys
 import re
@@ -8,10 +7,32 @@ import logging
 import subprocess
 import argparse
 import csv
-import Levenshtein
-from fuzzywuzzy import fuzz
+import functools
+from dataclasses import dataclass
+import numpy as np
 import argcomplete
 
+# rapidfuzz carries all the fast similarity kernels; without it the
+# pure-Python fallbacks below keep the tool working, just slower
+try:
+    from rapidfuzz import fuzz, process
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    fuzz = None
+    process = None
+    Levenshtein = None
+
+# Optional, SIMD assembly edit distance; rapidfuzz covers the same
+# call when it is not installed. The unicode variant counts characters
+# like rapidfuzz does, plain edit_distance works on UTF-8 bytes and
+# would inflate Hebrew distances. Newer stringzilla releases dropped
+# these from the core module, hence the getattr
+try:
+    import stringzilla
+    _sz_edit_distance = getattr(stringzilla, 'edit_distance_unicode', None)
+except ImportError:
+    _sz_edit_distance = None
+
 # A Levenshtein similarity score,
 # two strings below this distance
 # are considered "similar"
@@ -23,87 +44,90 @@ config = {
 }
 
 
+@dataclass(slots=True)
+class Sub:
+    """ A single subtitle entry and the action proposed for it
+
+    Slots keep thousands of records compact and make field access a
+    fixed-offset load instead of a dict lookup.
+    """
+    start: str = ""
+    end: str = ""
+    text: str = ""
+    action: str = "do nothing"
+
+
 def clean_text(text: str) -> str:
     """ Remove special charecters from text """
     ret = text.replace("\\n", "").replace("\\t", "")
     return ret
 
 
+# The entry template, bound once so the emit loop just fills it in
+_SRT_ENTRY_FORMAT = '{0}\n{1} --> {2}\n{3}\n\n'.format
+
+
 def get_srt_entry(index: int, start_time: str, end_time: str, text: str) -> str:
     """ A helper to create a subtitle entry from parameters """
-    srt_line = f'{index}\n{start_time} --> {end_time}\n{text}\n\n'
-    return srt_line
+    return _SRT_ENTRY_FORMAT(index, start_time, end_time, text)
+
+
+# Matches one SRT block: an index line, a timing line, then
+# the subtitle text up to a blank line or the end of the file
+_SRT_RE = re.compile(
+    r'(\d+)\r?\n([\d:,]+)\s*-->\s*([\d:,]+)\r?\n(.*?)(?=\r?\n\r?\n|\Z)',
+    re.DOTALL)
 
 
-def load_srt(input_srt: str) -> list:
+def _parse_srt_block(block: str):
+    """ Parse one blank-line delimited SRT block into a Sub, or None """
+    match = _SRT_RE.match(block)
+    if not match:
+        return None
+    return Sub(start=match.group(2),
+               end=match.group(3),
+               text=' '.join(match.group(4).splitlines()))
+
+
+def load_srt(input_srt: str):
     """ Load a .srt file
 
+    Streams the file one block at a time, so peak memory is a single
+    subtitle rather than the whole file plus a list of its lines.
+
     Args:
         input_srt(str): an srt file
-    Returns:
-        list[{start_time, end_time, text, action: 'do nothing'}, {...}, ...]
+    Yields:
+        Sub: the subtitles, all with the default 'do nothing' action
     """
-    subtitles = []
-
     with open(input_srt, 'r', encoding='utf-8') as srt_file:
-        lines = srt_file.read().splitlines()
-
-    index = 0
-
-    while index < len(lines):
-        if lines[index].isdigit():
-            index += 1  # Skip subtitle index
-            time_range = lines[index]
-            if '-->' not in time_range:
-                # Skip incomplete or unexpected data
-                index += 1
+        block_lines = []
+        for raw in srt_file:
+            line = raw.rstrip('\r\n')
+            if line:
+                block_lines.append(line)
                 continue
-
-            start_time, end_time = map(str.strip, time_range.split('-->'))
-            index += 1  # Move to the next line containing text
-            text = []
-            while index < len(lines) and lines[index]:
-                text.append(lines[index])
-                index += 1
-            subtitles.append({
-                'start-time': start_time,
-                'end-time': end_time,
-                'text': ' '.join(text),
-                'action': 'do nothing'
-            })
-
-        index += 1  # Move to the next subtitle
-
-    return subtitles
-
-
-def csv_safe(string: str) -> str:
-    """ Format string to be a safe CSV text"""
-    outstream = io.StringIO()   # "fake" output file
-    cw = csv.writer(outstream)  # pass the fake file to csv module
-    cw.writerow([string])       # write a row
-    return outstream.getvalue()  # get the contents of the fake file
+            if block_lines:
+                subtitle = _parse_srt_block('\n'.join(block_lines))
+                if subtitle:
+                    yield subtitle
+                block_lines = []
+        if block_lines:
+            subtitle = _parse_srt_block('\n'.join(block_lines))
+            if subtitle:
+                yield subtitle
 
 
 def save_actions(subtitles, output_csv):
     """ Save proposed actions to a CSV to be used to generate a new .srt file """
-    # Create a list to store rows for the CSV file
-    csv_rows = [['start_time', 'end_time', 'action', 'text']]
-
-    # Populate the list with subtitle information
-    for subtitle in subtitles:
-        # Escape CSV delimiter in text
-        start_time = subtitle['start-time']
-        end_time = subtitle['end-time']
-        action = subtitle['action']
-        text = subtitle['text']
-        entry = [start_time, end_time, action, text]
-        csv_rows.append(entry)
-
-    # Save the list to a CSV file
+    # writerows drains a generator of tuples, so the rows are never
+    # materialized and the whole write loop runs inside the csv module
     with open(output_csv, 'w', newline='', encoding='utf-8') as csv_file:
         csv_writer = csv.writer(csv_file, delimiter=',')
-        csv_writer.writerows(csv_rows)
+        csv_writer.writerow(('start_time', 'end_time', 'action', 'text'))
+        csv_writer.writerows((subtitle.start, subtitle.end,
+                              subtitle.action, subtitle.text)
+                             for subtitle in subtitles)
 
 
 def guess_sentence(sentences: list[str]) -> str | None:
@@ -115,69 +139,178 @@ def guess_sentence(sentences: list[str]) -> str | None:
     """
 
     print("Sentences to try and guess: ", sentences)
-    original_sentence = None
-    max_similarity = 0
+    if not sentences:
+        return None
+    if len(sentences) == 1:
+        return sentences[0]
+
+    if process is None:
+        # No rapidfuzz, average the pairwise similarity in the interpreter
+        best_sentence = None
+        best_total = -1.0
+        for i, sentence1 in enumerate(sentences):
+            total = 0.0
+            for j, sentence2 in enumerate(sentences):
+                if i == j:
+                    continue
+                len_max = max(len(sentence1), len(sentence2), 1)
+                total += 1 - _wagner_fischer(sentence1, sentence2, len_max) / len_max
+            if total > best_total:
+                best_total = total
+                best_sentence = sentence1
+        return best_sentence
+
+    # Score every sentence against every other in one C level call,
+    # spread across rapidfuzz's thread pool
+    scores = process.cdist(sentences, sentences, scorer=fuzz.ratio, workers=-1)
+    np.fill_diagonal(scores, 0)
+
+    # Pick the sentence most similar to all the others on average
+    average_similarity = scores.sum(axis=1) / (len(sentences) - 1)
+    return sentences[int(average_similarity.argmax())]
+
+
+def classify_garbage(texts: list, delete_re) -> list:
+    """ Classify every subtitle text as garbage in one batched sweep
 
-    for i, sentence1 in enumerate(sentences):
-        similarity_sum = 0
-
-        for j, sentence2 in enumerate(sentences):
-            if i != j:  # Avoid comparing the same sentence
-                # Calculate similarity using fuzz ratio
-                similarity_sum += fuzz.ratio(sentence1, sentence2)
+    Args:
+        texts(list[str]): the subtitle texts
+        delete_re: a compiled pattern from compile_delete_list,
+            text matching it is considered garbage, may be None
+    Returns:
+        list[bool]: a garbage verdict per text
+    """
+    # Add your criteria for identifying garbage text
+    # One strip serves both cheap checks, and they run before the
+    # comparatively expensive regex scan; the search method is bound
+    # once for the whole batch
+    search = delete_re.search if delete_re else None
+    flags = []
+    for text in texts:
+        stripped = text.strip()
+        flags.append(len(stripped) < 3 or stripped.isdigit()
+                     or (search is not None and search(text) is not None))
+    return flags
 
-        # Average similarity across all comparisons
-        average_similarity = similarity_sum / (len(sentences) - 1)
 
-        if average_similarity > max_similarity:
-            max_similarity = average_similarity
-            original_sentence = sentence1
+def is_garbage(text: str, delete_re) -> bool:
+    """ Try and guess if a single text is garbage, see classify_garbage """
+    return classify_garbage([text], delete_re)[0]
 
-    return original_sentence
 
+def is_similar(prev_text: str, current_text: str, cutoff: float = SIMILARITY_CUTOFF) -> bool:
+    """ Decide if two strings are similar enought to suggest merge
 
-def is_garbage(text: str, delete_list: list) -> bool:
-    """ Try and guess if text is garbage
+    The distance is bounded by the cutoff, so the underlying DP bails
+    out as soon as a pair can no longer come in under the merge
+    threshold; the exact distance is never needed, only the verdict.
 
-    Args:
-        text(str): The text to check
-        delete_list(list[regex]): A list of regular expresisons,
-            when text matches an entry in delete_list consider it garbage
+    The equality and length gates below are the only proxies worth
+    running in the interpreter: anything per-character (Sift3, token
+    Jaccard and friends) costs more in Python than the bounded
+    bit-parallel C distance it would be standing in for.
     """
-    # Add your criteria for identifying garbage text
-    if delete_list:
-        for d in delete_list:
-            if d.search(text):
-                return True
-    if len(text) < 3 or text.isdigit() or text.strip() == "1":
+    if prev_text == current_text:
+        # Identical lines are common and need no distance at all
+        logging.debug("merge %s", current_text)
         return True
-    return False
+    len_min = min(len(prev_text), len(current_text))
+    len_max = max(len(prev_text), len(current_text))
+    max_distance = int(cutoff * len_max)
+    # The distance is at least the length difference, so mismatched
+    # lengths alone can reject a pair with two integer compares
+    if len_max - len_min > max_distance:
+        return False
+    # Distance is symmetric, sort the pair so both orderings share
+    # one cache slot
+    text_a, text_b = sorted((prev_text, current_text))
+    if _bounded_distance(text_a, text_b, max_distance) > max_distance:
+        return False
+    logging.debug("merge %s", current_text)
+    return True
+
+
+@functools.lru_cache(maxsize=4096)
+def _bounded_distance(text_a: str, text_b: str, max_distance: int) -> int:
+    """ Edit distance bounded by max_distance, cached for repeated pairs
+
+    Subtitles repeat speaker tags and recurring captions, so identical
+    pairs come up many times across a file.
+
+    Takes str, never pre-encoded bytes: UTF-8 doubles the length of
+    Hebrew text, which halves byte-level normalized distances and
+    shifts the merge threshold, and rapidfuzz reads CPython's unicode
+    buffers directly without an encode of its own anyway.
+    """
+    if _sz_edit_distance is not None:
+        return _sz_edit_distance(text_a, text_b, bound=max_distance + 1)
+    if Levenshtein is not None:
+        return Levenshtein.distance(text_a, text_b, score_cutoff=max_distance)
+    return _wagner_fischer(text_a, text_b, max_distance)
 
 
-def normalized_levenshtein_distance(str1: str, str2: str) -> float:
-    """ Returns a Levenshtein distance score normalised by string length
+def _wagner_fischer(text_a: str, text_b: str, max_distance: int) -> int:
+    """ Rolling-row Wagner-Fischer edit distance with an early exit
 
-    Args:
-        str1(str): String A
-        str2(str): String B
-    Returns(float): The Levenshtein score
+    Pure-Python fallback for installs without stringzilla or rapidfuzz.
+    Keeps a single row of the DP table and returns max_distance + 1 as
+    soon as the row minimum proves the bound can no longer be met.
     """
-    len_max = max(len(str1), len(str2))
-    if len_max == 0:
-        return 0  # Both strings are empty, consider them similar
+    row = list(range(len(text_b) + 1))
+    for i, char_a in enumerate(text_a, start=1):
+        prev_diag = row[0]
+        row[0] = i
+        row_min = i
+        for j, char_b in enumerate(text_b, start=1):
+            value = min(prev_diag + (char_a != char_b),
+                        row[j] + 1,
+                        row[j - 1] + 1)
+            prev_diag = row[j]
+            row[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return max_distance + 1
+    return min(row[-1], max_distance + 1)
+
+
+# process.cpdist scores element-wise pairs in one call, rapidfuzz
+# grew it in the 3.x line hence the guard
+_cpdist = getattr(process, 'cpdist', None)
+
+
+def batch_is_similar(texts_a: list, texts_b: list, cutoff: float) -> list:
+    """ Decide similarity for many subtitle pairs in one batch
+
+    The whole pair list goes through a single cpdist call: raw edit
+    distances computed in C across a thread pool, with a shared bound
+    pushed down so each DP still bails out early. Comparing raw
+    distances against the same truncated per-pair bound is_similar uses
+    keeps the two paths agreeing on pairs that land exactly on the
+    cutoff, where rapidfuzz's own normalized score_cutoff rounds the
+    other way.
 
-    distance = Levenshtein.distance(str1, str2)
-    ret = distance / len_max
-    logging.debug("\"%s\" is similar to \"%s\" by %s", str1, str2, ret)
-    return ret
-
-
-def is_similar(prev_text: str, current_text: str, cutoff: float = SIMILARITY_CUTOFF) -> bool:
-    """ Decide if two strings are similar enought to suggest merge """
-    if normalized_levenshtein_distance(prev_text, current_text) <= cutoff:
-        logging.debug("merge %s", current_text)
-        return True
-    return False
+    Args:
+        texts_a(list[str]): left hand side of each pair
+        texts_b(list[str]): right hand side of each pair, same length
+        cutoff(float): the merge similarity cutoff
+    Returns:
+        list[bool]: whether each pair is similar enough to merge
+    """
+    if not texts_a:
+        return []
+    if _cpdist is None:
+        # Older rapidfuzz, score the pairs one at a time
+        return [is_similar(a, b, cutoff) for a, b in zip(texts_a, texts_b)]
+    bounds = [int(cutoff * max(len(a), len(b)))
+              for a, b in zip(texts_a, texts_b)]
+    # cpdist takes one scalar cutoff, the loosest per-pair bound; pairs
+    # clamped above it are already over their own tighter bound too
+    distances = _cpdist(texts_a, texts_b,
+                        scorer=Levenshtein.distance,
+                        score_cutoff=max(bounds),
+                        workers=-1)
+    return [distance <= bound for distance, bound in zip(distances, bounds)]
 
 
 def edit_actions(actions_file: str):
@@ -186,94 +319,150 @@ def edit_actions(actions_file: str):
     subprocess.run([editor_command, actions_file], check=True)
 
 
-def apply_actions(actions_csv_file: str, output_srt_file: str):
-    """ Apply actions in actions in action_csv_file to create output_srt file"""
-    # Load actions from the CSV file
-    actions = []
-    with open(actions_csv_file, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            actions.append(row)
+def apply_actions_from_records(records, output_srt_file: str):
+    """ Apply in-memory action records to create output_srt_file
 
+    Args:
+        records: an iterable of Sub records with actions populated
+        output_srt_file(str): the srt file to write
+    """
     # Generate SRT content based on actions
-    srt_content = []
-    current_subtitle = {'start-time': '', 'end-time': '', 'text': ''}
+    parts = []
+    idx = 0  # Running subtitle index in the output file
+    current_subtitle = Sub()
 
-    for action in actions:
-        print("action: ", action)
-        if action['action'] == 'delete':
+    for record in records:
+        print("action: ", record)
+        if record.action == 'delete':
             # Skip this entry if action is 'delete'
             continue
-        elif action['action'] == 'merge':
+        elif record.action == 'merge':
             # Set the end time of the last subtitle to be the current subtitle's end time
-            # current_subtitle['end-time'] = action['end_time']
+            # current_subtitle.end = record.end
             continue
         else:
             # On 'do nothing' and 'merge to'
             # Save the current subtitle to the SRT content list
-            if current_subtitle['start-time'] != '':
-                srt_content.append(get_srt_entry(
-                    len(srt_content)+1,
-                    current_subtitle["start-time"],
-                    current_subtitle["end-time"],
-                    current_subtitle["text"]))
-
-            # Update current_subtitle with the current action
-            current_subtitle['start-time'] = action['start_time']
-            current_subtitle['end-time'] = action['end_time']
-            current_subtitle['text'] = action['text']
+            if current_subtitle.start != '':
+                idx += 1
+                parts.append(get_srt_entry(
+                    idx,
+                    current_subtitle.start,
+                    current_subtitle.end,
+                    current_subtitle.text))
+
+            # Update current_subtitle with the current record
+            current_subtitle.start = record.start
+            current_subtitle.end = record.end
+            current_subtitle.text = record.text
 
     # Save the last subtitle to the SRT content list
-    srt_content.append(f"{len(srt_content) + 1}\n"
-                       f"{current_subtitle['start-time']} --> {current_subtitle['end-time']}\n"
-                       f"{current_subtitle['text']}\n\n")
+    idx += 1
+    parts.append(get_srt_entry(
+        idx, current_subtitle.start, current_subtitle.end, current_subtitle.text))
 
-    # Write the SRT content to the output SRT file
+    # One join and one write instead of many small buffered writes
     with open(output_srt_file, 'w', encoding='utf-8') as srt_file:
-        srt_file.writelines(srt_content)
+        srt_file.write("".join(parts))
+
+
+def apply_actions(actions_csv_file: str, output_srt_file: str):
+    """ Apply actions in actions in action_csv_file to create output_srt file"""
+    with open(actions_csv_file, 'r', encoding='utf-8') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, [])
+        # Bind each column name to its position once; plain rows plus
+        # integer indexing skip DictReader's dict per row
+        columns = {name: i for i, name in enumerate(header)}
+        col_start = columns.get('start_time')
+        col_end = columns.get('end_time')
+        col_action = columns.get('action')
+        col_text = columns.get('text')
+        apply_actions_from_records(
+            (Sub(start=row[col_start], end=row[col_end],
+                 text=row[col_text], action=row[col_action])
+             for row in csv_reader),
+            output_srt_file)
+
+
+def compile_delete_list(delete_list: list):
+    """ Combine the delete regular expressions into one compiled pattern
+
+    A single alternation means the regex engine scans each subtitle
+    once no matter how many patterns the user supplied.
+
+    Args:
+        delete_list(list[str]): regular expression patterns, or None
+    Returns:
+        a compiled pattern matching any of them, None when there are none
+    """
+    if not delete_list:
+        return None
+    return re.compile("|".join(f"(?:{r})" for r in delete_list))
 
 
-def process_subtitles(subtitle_action_list: list, delete_list: list, similarity: float) -> list:
-    """ Process a subtitle action list, populates actions """
+def process_subtitles(subtitle_action_list: list, delete_re, similarity: float) -> list:
+    """ Process a subtitle action list, populates actions
+
+    Args:
+        subtitle_action_list: Sub records, a list or the load_srt generator
+        delete_re: combined pattern from compile_delete_list, may be None
+        similarity(float): the merge similarity cutoff
+    """
     ret = []
-    if delete_list is None:
-        delete_list = []
-    else:
-        delete_list = [re.compile(r) for r in delete_list]
+
+    # load_srt streams, and the passes below need the records twice
+    subtitle_action_list = list(subtitle_action_list)
+    for subtitle in subtitle_action_list:
+        subtitle.text = clean_text(subtitle.text)
+    texts = [subtitle.text for subtitle in subtitle_action_list]
+    garbage = classify_garbage(texts, delete_re)
+
+    # Pair every kept subtitle with the previous kept one and score all
+    # the pairs in one batch instead of a distance call per iteration
+    pair_index = {}  # subtitle position -> position in the pair batch
+    left = []
+    right = []
+    prev_pos = None
+    for pos, is_junk in enumerate(garbage):
+        if is_junk:
+            continue
+        if prev_pos is not None:
+            pair_index[pos] = len(left)
+            left.append(texts[prev_pos])
+            right.append(texts[pos])
+        prev_pos = pos
+    similar = batch_is_similar(left, right, similarity)
 
     merging = False  # Keeps track of wether we are inside a merge operation
     merging_list = []
     mergins_start_time = ""
-    prev_subtitle = {}
-    # for i, subtitle in enumerate(subtitle_action_list):
-    for subtitle in subtitle_action_list:
-        subtitle['text'] = clean_text(subtitle['text'])
+    prev_subtitle = None
+    for pos, subtitle in enumerate(subtitle_action_list):
         ret.append(subtitle)
         # Decide on an action, `merge`, 'delete' or 'do nothing'
-        if is_garbage(subtitle['text'], delete_list):
-            logging.debug("delete: %s", subtitle["text"])
-            subtitle['action'] = 'delete'
+        if garbage[pos]:
+            logging.debug("delete: %s", subtitle.text)
+            subtitle.action = 'delete'
             continue
-        if prev_subtitle and is_similar(prev_subtitle['text'], subtitle['text'], similarity):
+        if pos in pair_index and similar[pair_index[pos]]:
             # This is the start of a merging sequence
             if not merging:
                 merging = True
-                mergins_start_time = prev_subtitle['start-time']
-                prev_subtitle['action'] = 'merge'
-                merging_list.append(prev_subtitle['text'])
-            merging_list.append(subtitle["text"])
-            subtitle['action'] = 'merge'
+                mergins_start_time = prev_subtitle.start
+                prev_subtitle.action = 'merge'
+                merging_list.append(prev_subtitle.text)
+            merging_list.append(subtitle.text)
+            subtitle.action = 'merge'
 
         # Ending merge sequence
-        if subtitle['action'] == 'do nothing' and merging:
+        if subtitle.action == 'do nothing' and merging:
             merging = False
             guess = guess_sentence(merging_list)
-            merging_entry = {
-                "start-time": mergins_start_time,
-                "end-time": subtitle["end-time"],
-                "action": "merge to",
-                "text": guess
-            }
+            merging_entry = Sub(start=mergins_start_time,
+                                end=subtitle.end,
+                                text=guess,
+                                action="merge to")
             ret.insert(-1, merging_entry)
             merging_list = []
         prev_subtitle = subtitle
@@ -306,6 +495,8 @@ def main():
     """ Main, no a lot more to say but pylint insists i say something """
 
     args = parse_args()
+    # Stale distances must not leak between files
+    _bounded_distance.cache_clear()
     srt_file = args.srt_file
     output_srt_file = args.output_srt_file
     apply_actions_csv = args.apply_actions_csv
@@ -323,8 +514,16 @@ def main():
     subtitles = load_srt(srt_file)
     subtitles = process_subtitles(
         subtitles,
-        delete_list=args.delete,
+        delete_re=compile_delete_list(args.delete),
         similarity=args.threshold)
+
+    if args.confirm and not dont_apply:
+        # Nothing to inspect, apply the in-memory actions directly and
+        # skip the CSV write-then-parse round trip
+        apply_actions_from_records(subtitles, output_srt_file)
+        logging.info("%s written", output_srt_file)
+        return
+
     save_actions(subtitles=subtitles, output_csv=action_csv_file)
     if not args.confirm:
         choice = input("Created actionable list [C]confirm, [i]nspect.")